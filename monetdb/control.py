@@ -15,61 +15,272 @@
 # Copyright August 2008-2015 MonetDB B.V.
 # All Rights Reserved.
 
+import functools
 import platform
+import queue
+import re
+import time
+from select import select
 from datetime import datetime as dt
 from monetdb import mapi
 from monetdb.exceptions import OperationalError, InterfaceError
 
 
+# property lines of a get result, optionally prefixed with "=", skipping
+# "#" comment lines
+_GET_RE = re.compile(r'^=?(?!#)([^=\n]+)=(.*)$', re.M)
+
+
+# characters which make a database name a glob-style pattern
+_GLOB_CHARS = frozenset("*?[")
+
+
+# encoded suffixes of the fixed commands, the database name is prepended
+_CMD_BYTES = {command: (" %s\n" % command).encode() for command in (
+    "create", "destroy", "lock", "release", "status", "start", "stop",
+    "kill", "get")}
+
+
+@functools.lru_cache(maxsize=128)
+def _set_suffix(property_, value):
+    """ the encoded suffix of a set command, scripts often set the same
+    property to the same value for many databases """
+    return b"".join((b" ", property_.encode(), b"=", value.encode(), b"\n"))
+
+
+@functools.lru_cache(maxsize=1024)
+def _ts(value):
+    """ converts a timestamp to a datetime, the same ones repeat a lot """
+    return dt.fromtimestamp(value)
+
+
+def _opt_ts(value):
+    """ like _ts(), but a negative timestamp means never and gives None """
+    return _ts(value) if value >= 0 else None
+
+
+def _parse_v1(parts):
+    (name, path, locked, state, scenarios, _, start_counter, stop_counter,
+     crash_counter, avg_uptime, max_uptime, min_uptime, last_crash,
+     last_start, crash_avg1, crash_avg10, crash_avg30, *_) = parts
+    return {
+        'name': name,
+        'path': path,
+        'locked': locked == "1",
+        'state': int(state),
+        'scenarios': scenarios.split("'"),
+        'start_counter': int(start_counter),
+        'stop_counter': int(stop_counter),
+        'crash_counter': int(crash_counter),
+        'avg_uptime': int(avg_uptime),
+        'max_uptime': int(max_uptime),
+        'min_uptime': int(min_uptime),
+        'last_crash': _opt_ts(int(last_crash)),
+        'last_start': _ts(int(last_start)),
+        'crash_avg1': crash_avg1 == "1",
+        'crash_avg10': float(crash_avg10),
+        'crash_avg30': float(crash_avg30),
+    }
+
+
+def _parse_v2(parts):
+    (name, path, locked, state, scenarios, start_counter, stop_counter,
+     crash_counter, avg_uptime, max_uptime, min_uptime, last_crash,
+     last_start, last_stop, crash_avg1, crash_avg10, crash_avg30, *_) = parts
+    return {
+        'name': name,
+        'path': path,
+        'locked': locked == "1",
+        'state': int(state),
+        'scenarios': scenarios.split("'"),
+        'start_counter': int(start_counter),
+        'stop_counter': int(stop_counter),
+        'crash_counter': int(crash_counter),
+        'avg_uptime': int(avg_uptime),
+        'max_uptime': int(max_uptime),
+        'min_uptime': int(min_uptime),
+        'last_crash': _opt_ts(int(last_crash)),
+        'last_start': _ts(int(last_start)),
+        'last_stop': _opt_ts(int(last_stop)),
+        'crash_avg1': crash_avg1 == "1",
+        'crash_avg10': float(crash_avg10),
+        'crash_avg30': float(crash_avg30),
+    }
+
+
+# sabdb protocol version -> parser for the comma separated fields
+_PARSERS = {
+    "1": _parse_v1,
+    "2": _parse_v2,
+}
+
+
+def _timestamp(value):
+    return _ts(int(value))
+
+
+def _optional_timestamp(value):
+    return _opt_ts(int(value))
+
+
+def _scenarios(value):
+    return value.split("'")
+
+
+# conversion of the raw values of every StatusTable column, None keeps them
+_CONVERTERS = {
+    'name': None,
+    'path': None,
+    'locked': "1".__eq__,
+    'state': int,
+    'scenarios': _scenarios,
+    'start_counter': int,
+    'stop_counter': int,
+    'crash_counter': int,
+    'avg_uptime': int,
+    'max_uptime': int,
+    'min_uptime': int,
+    'last_crash': _optional_timestamp,
+    'last_start': _timestamp,
+    'last_stop': _optional_timestamp,
+    'crash_avg1': "1".__eq__,
+    'crash_avg10': float,
+    'crash_avg30': float,
+}
+
+# sabdb protocol version -> the comma separated fields of a status line in
+# the order the parser above unpacks them, None marks a field which is not
+# used. Used to check the length of a line and to build a StatusTable
+_FIELDS = {
+    "1": ('name', 'path', 'locked', 'state', 'scenarios', None,
+          'start_counter', 'stop_counter', 'crash_counter', 'avg_uptime',
+          'max_uptime', 'min_uptime', 'last_crash', 'last_start',
+          'crash_avg1', 'crash_avg10', 'crash_avg30'),
+    "2": ('name', 'path', 'locked', 'state', 'scenarios', 'start_counter',
+          'stop_counter', 'crash_counter', 'avg_uptime', 'max_uptime',
+          'min_uptime', 'last_crash', 'last_start', 'last_stop',
+          'crash_avg1', 'crash_avg10', 'crash_avg30'),
+}
+
+# fields of a protocol version -> the StatusTable fields it doesn't have.
+# That is only last_stop for v1, its raw value -1 means never
+_ABSENT_FIELDS = {fields: [field for field in _FIELDS["2"]
+                           if field not in fields]
+                  for fields in _FIELDS.values()}
+
+
 def parse_statusline(line):
     """
-    parses a sabdb format status line. Support v1 and v2.
-
+    parses a sabdb format status line. Support v1 and v2. line can be
+    a str or bytes.
     """
+    if isinstance(line, bytes):
+        line = line.decode()
     if line.startswith("="):
         line = line[1:]
+    return _parse_statusline(line)
+
+
+def _split_statusline(line):
+    """ checks a status line without "=" prefix, returns its protocol
+    version and the raw values """
     if not line.startswith('sabdb:'):
         raise OperationalError('wrong result recieved')
 
     code, prot_version, rest = line.split(":", 2)
-
-    if prot_version not in ["1", "2"]:
+    try:
+        fields = _FIELDS[prot_version]
+    except KeyError:
         raise InterfaceError("unsupported sabdb protocol")
-    else:
-        prot_version = int(prot_version)
-
-    subparts = rest.split(',')
-    sub_iter = iter(subparts)
-
-    info = {}
-
-    info['name'] = next(sub_iter)
-    info['path'] = next(sub_iter)
-    info['locked'] = next(sub_iter) == "1"
-    info['state'] = int(next(sub_iter))
-    info['scenarios'] = next(sub_iter).split("'")
-    if prot_version == 1:
-        next(sub_iter)
-    info['start_counter'] = int(next(sub_iter))
-    info['stop_counter'] = int(next(sub_iter))
-    info['crash_counter'] = int(next(sub_iter))
-    info['avg_uptime'] = int(next(sub_iter))
-    info['max_uptime'] = int(next(sub_iter))
-    info['min_uptime'] = int(next(sub_iter))
-    last_crash = int(next(sub_iter))
-    info['last_crash'] = dt.fromtimestamp(int(last_crash)) if last_crash >= 0 else None
-    info['last_start'] = dt.fromtimestamp(int(next(sub_iter)))
-    if prot_version > 1:
-        value = int(next(sub_iter))
-        if value > -1:
-            info['last_stop'] = dt.fromtimestamp(value)
-        else:
-            info['last_stop'] = None
-    info['crash_avg1'] = next(sub_iter) == "1"
-    info['crash_avg10'] = float(next(sub_iter))
-    info['crash_avg30'] = float(next(sub_iter))
-
-    return info
+    values = rest.split(',')
+    if len(values) < len(fields):
+        raise OperationalError('wrong result recieved')
+    return prot_version, values
+
+
+def _parse_statusline(line):
+    """ parse_statusline() for a line without the "=" prefix """
+    prot_version, values = _split_statusline(line)
+    return _PARSERS[prot_version](values)
+
+
+def parse_statuslines(raw):
+    """
+    parses all sabdb format status lines in the result of a "#all status"
+    command, returns a list of dicts like parse_statusline().
+    """
+    return [_parse_statusline(line) for line in _statuslines(raw)]
+
+
+def _statuslines(raw):
+    """ splits a status result, str or bytes, into lines without their "="
+    prefixes """
+    if isinstance(raw, bytes):
+        raw = raw.decode()
+    raw = raw.replace("\n=", "\n")
+    if raw.startswith("="):
+        raw = raw[1:]
+    return raw.splitlines()
+
+
+class StatusTable:
+    """
+    The status of many databases, stored per field instead of per database.
+    Every attribute is a list with one value for each database, so
+    table.state[i] is the state of the database named table.name[i].
+    last_stop is None for databases reported with sabdb protocol v1.
+    """
+    __slots__ = _FIELDS["2"]
+
+    def __init__(self):
+        for field in self.__slots__:
+            setattr(self, field, [])
+
+    def __len__(self):
+        return len(self.name)
+
+
+def _statustable(lines):
+    """ builds a StatusTable from status lines without "=" prefix """
+    columns = {field: [] for field in StatusTable.__slots__}
+    for line in lines:
+        prot_version, values = _split_statusline(line)
+        fields = _FIELDS[prot_version]
+        for field, value in zip(fields, values):
+            if field is not None:
+                columns[field].append(value)
+        for field in _ABSENT_FIELDS[fields]:
+            columns[field].append("-1")
+
+    table = StatusTable()
+    for field, column in columns.items():
+        convert = _CONVERTERS[field]
+        if convert is not None:
+            column = list(map(convert, column))
+        setattr(table, field, column)
+    return table
+
+
+def parse_statuslines_columnar(raw):
+    """
+    parses all sabdb format status lines in the result of a "#all status"
+    command into a StatusTable.
+    """
+    return _statustable(_statuslines(raw))
+
+
+def _statusline_name(line):
+    """ the database name of a status line without "=" prefix """
+    return line.split(":", 2)[-1].partition(",")[0]
+
+
+def _is_stale(connection):
+    """ an idle connection has nothing to read, unless the server closed it
+    or it holds an old reply. Either way it can't be used anymore """
+    try:
+        return bool(select([connection.socket], [], [], 0)[0])
+    except (OSError, ValueError):
+        return True
 
 
 def isempty(result):
@@ -85,8 +296,11 @@ class Control:
     Use this module to manage your MonetDB databases. You can create, start,
     stop, lock, unlock, destroy your databases and request status information.
     """
+    # seconds a status result is reused before it is requested again
+    status_ttl = 0.5
+
     def __init__(self, hostname=None, port=50000, passphrase=None,
-                 unix_socket=None):
+                 unix_socket=None, pool_size=1):
 
         if not unix_socket:
             unix_socket = "/tmp/.s.merovingian.%i" % port
@@ -99,24 +313,118 @@ class Control:
         self.port = port
         self.passphrase = passphrase
         self.unix_socket = unix_socket
+        self._status_cache = None
 
-        # check connection
-        self.server.connect(hostname=hostname, port=port, username='monetdb',
-                            password=passphrase,
-                            database='merovingian', language='control',
-                            unix_socket=unix_socket)
-        self.server.disconnect()
-
-    def _send_command(self, database_name, command):
-        self.server.connect(hostname=self.hostname, port=self.port,
-                            username='monetdb', password=self.passphrase,
-                            database='merovingian', language='control',
-                            unix_socket=self.unix_socket)
+        # check connection, and keep it around for the first command
         try:
-            return self.server.cmd("%s %s\n" % (database_name, command))
-        finally:
-            # always close connection
+            self._connect(self.server)
+        except Exception:
             self.server.disconnect()
+            raise
+
+        # pool of connections, so multiple threads can share one Control
+        self._connections = [self.server]
+        self._connections += [mapi.Connection() for _ in range(pool_size - 1)]
+        self._pool = queue.Queue()
+        for connection in self._connections:
+            self._pool.put(connection)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _connect(self, connection):
+        connection.connect(hostname=self.hostname, port=self.port,
+                           username='monetdb', password=self.passphrase,
+                           database='merovingian', language='control',
+                           unix_socket=self.unix_socket)
+
+    def _cmd(self, connection, operation, read_only):
+        if connection.state == mapi.STATE_READY and _is_stale(connection):
+            connection.disconnect()
+        if connection.state != mapi.STATE_READY:
+            self._connect(connection)
+            return connection.cmd(operation)
+        try:
+            return connection.cmd(operation)
+        except OperationalError:
+            if not (read_only and connection.connectionclosed):
+                raise
+        except OSError:
+            if not read_only:
+                raise
+        # the server dropped our connection. The command may already have
+        # been executed, so only a read only command is safe to repeat
+        connection.disconnect()
+        self._connect(connection)
+        return connection.cmd(operation)
+
+    def _send_command(self, database_name, command, read_only=False):
+        suffix = _CMD_BYTES.get(command)
+        if suffix is None:
+            suffix = (" %s\n" % command).encode()
+        return self._send_command_bytes(database_name, suffix, read_only)
+
+    def _send_command_bytes(self, database_name, suffix, read_only=False):
+        """ sends database_name followed by the encoded suffix, which holds
+        the command and the terminating newline. A read_only command is
+        sent again if the connection breaks while it runs """
+        operation = database_name.encode() + suffix
+        connection = self._pool.get()
+        try:
+            return self._cmd(connection, operation, read_only)
+        except OperationalError:
+            if connection.connectionclosed or \
+                    connection.state != mapi.STATE_READY:
+                connection.disconnect()
+            raise
+        except BaseException:
+            # part of the reply may still be unread, never reuse this one
+            connection.disconnect()
+            raise
+        finally:
+            if not connection.hostname:
+                # merovingian closes a unix socket after every command
+                connection.disconnect()
+            self._pool.put(connection)
+
+    def _send_update(self, database_name, command):
+        """ sends a command which changes a database, command is a str or
+        an encoded suffix for _send_command_bytes """
+        try:
+            if isinstance(command, bytes):
+                return self._send_command_bytes(database_name, command)
+            return self._send_command(database_name, command)
+        finally:
+            self.invalidate_status()
+
+    def _statuses(self):
+        cache = self._status_cache
+        if cache is None or time.monotonic() - cache[0] >= self.status_ttl:
+            now = time.monotonic()
+            raw = self._send_command("#all", "status", read_only=True)
+            # keep the lines, only the ones asked for are parsed
+            statuses = {_statusline_name(line): line
+                        for line in _statuslines(raw)}
+            cache = self._status_cache = (now, statuses)
+        return cache[1]
+
+    def invalidate_status(self):
+        """
+        Forgets the cached status information, the next status request
+        will ask the MonetDB Database Server again.
+        """
+        self._status_cache = None
+
+    def close(self):
+        """
+        Closes all connections to the MonetDB Database Server. The Control
+        object can still be used afterwards, it will reconnect when needed.
+        """
+        for connection in self._connections:
+            connection.disconnect()
 
     def create(self, database_name):
         """
@@ -124,7 +432,7 @@ class Control:
         A database created with this command makes it available  for use,
         however in maintenance mode (see monetdb lock).
         """
-        return isempty(self._send_command(database_name, "create"))
+        return isempty(self._send_update(database_name, "create"))
 
     def destroy(self, database_name):
         """
@@ -132,7 +440,7 @@ class Control:
         logfiles.  Once destroy has completed, all data is lost.
         Be careful when using this command.
         """
-        return isempty(self._send_command(database_name, "destroy"))
+        return isempty(self._send_update(database_name, "destroy"))
 
     def lock(self, database_name):
         """
@@ -142,7 +450,7 @@ class Control:
         automatically.  Use the "release" command to bring
         the database back for normal usage.
         """
-        return isempty(self._send_command(database_name, "lock"))
+        return isempty(self._send_update(database_name, "lock"))
 
     def release(self, database_name):
         """
@@ -150,34 +458,61 @@ class Control:
         database is available again for normal use.  Use the
         "lock" command to take a database under maintenance.
         """
-        return isempty(self._send_command(database_name, "release"))
+        return isempty(self._send_update(database_name, "release"))
 
-    def status(self, database_name=False):
+    def status(self, database_name=None):
         """
         Shows the state of a given glob-style database match, or
         all known if none given.  Instead of the normal mode, a
         long and crash mode control what information is displayed.
         """
-        if database_name:
-            raw = self._send_command(database_name, "status")
-            return parse_statusline(raw)
-        else:
-            raw = self._send_command("#all", "status")
-            return [parse_statusline(line) for line in raw.split("\n")]
+        if not database_name:
+            return self._status_all()
+        return self._status_one(database_name)
+
+    def _status_all(self):
+        return [_parse_statusline(line)
+                for line in self._statuses().values()]
+
+    def _status_one(self, database_name):
+        if not _GLOB_CHARS.intersection(database_name):
+            statuses = self._statuses()
+            if database_name in statuses:
+                return _parse_statusline(statuses[database_name])
+        raw = self._send_command(database_name, "status", read_only=True)
+        return parse_statusline(raw)
+
+    def status_table(self):
+        """
+        Shows the state of all known databases as a StatusTable, which is
+        cheaper to build than a dict per database.
+        """
+        return _statustable(list(self._statuses().values()))
+
+    def status_many(self, names=None):
+        """
+        Shows the state of the given databases, or all known if none
+        given, using a single request to the MonetDB Database Server.
+        """
+        if names is None:
+            return self._status_all()
+        statuses = self._statuses()
+        return [_parse_statusline(statuses[name])
+                for name in names if name in statuses]
 
     def start(self, database_name):
         """
         Starts the given database, if the MonetDB Database Server
         is running.
         """
-        return isempty(self._send_command(database_name, "start"))
+        return isempty(self._send_update(database_name, "start"))
 
     def stop(self, database_name):
         """
         Stops the given database, if the MonetDB Database Server
         is running.
         """
-        return isempty(self._send_command(database_name, "stop"))
+        return isempty(self._send_update(database_name, "stop"))
 
     def kill(self, database_name):
         """
@@ -186,38 +521,31 @@ class Control:
         as last resort to stop a database.  A database being
         killed may end up with data loss.
         """
-        return isempty(self._send_command(database_name, "kill"))
+        return isempty(self._send_update(database_name, "kill"))
 
     def set(self, database_name, property_, value):
         """
         sets property to value for the given database
         for a list of properties, use `monetdb get all`
         """
-        return isempty(self._send_command(database_name, "%s=%s" % (property_,
-                                                                    value)))
+        command = _set_suffix(property_, str(value))
+        return isempty(self._send_update(database_name, command))
 
     def get(self, database_name):
         """
         gets value for property for the given database, or
         retrieves all properties for the given database
         """
-        properties = self._send_command(database_name, "get")
-        values = {}
-        for line in properties.split("\n"):
-            if line.startswith("="):
-                line = line[1:]
-            if not line.startswith("#"):
-                if "=" in line:
-                    split = line.split("=")
-                    values[split[0]] = split[1]
-        return values
+        properties = self._send_command(database_name, "get", read_only=True)
+        return dict(_GET_RE.findall(properties))
 
     def inherit(self, database_name, property_):
         """
         unsets property, reverting to its inherited value from
         the default configuration for the given database
         """
-        return isempty(self._send_command(database_name, property_ + "="))
+        command = b"".join((b" ", property_.encode(), b"=\n"))
+        return isempty(self._send_update(database_name, command))
 
     def rename(self, old, new):
         return self.set(old, "name", new)
@@ -226,4 +554,5 @@ class Control:
         return self.get("#defaults")
 
     def neighbours(self):
-        return self._send_command("anelosimus", "eximius")
+        return self._send_command("anelosimus", "eximius",
+                                  read_only=True)
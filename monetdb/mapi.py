@@ -78,6 +78,8 @@ class Connection(object):
         self.database = ""
         self.language = ""
         self.connectionclosed = False
+        self._password_hashes = {}
+        self._sendbuf = bytearray()  # reused for every outgoing packet
 
     def connect(self, database, username, password, language, hostname=None,
                 port=None, unix_socket=None, var_async=False):
@@ -102,6 +104,7 @@ class Connection(object):
         self.language = language
         self.unix_socket = unix_socket
         self.var_async = var_async
+        self.connectionclosed = False
 
         self.__isexecuting = False
 
@@ -176,10 +179,12 @@ class Connection(object):
     def disconnect(self):
         """ disconnect from the monetdb server """
         self.state = STATE_INIT
-        self.socket.close()
+        if self.socket:
+            self.socket.close()
 
     def cmd(self, operation, f=None):
-        """ put a mapi command on the line"""
+        """ put a mapi command on the line, operation can be a str or
+        already encoded bytes """
         logger.debug("executing command %s" % operation)
 
         if self.state != STATE_READY:
@@ -195,7 +200,7 @@ class Connection(object):
             elif response == MSG_MORE:
                 if f is not None:
                     operation = f.read(4096)
-                    if operation != "":
+                    if operation:
                         continue
                 return self.cmd("")
             elif response[0] in [MSG_Q, MSG_HEADER, MSG_TUPLE]:
@@ -237,16 +242,9 @@ class Connection(object):
         """ generate a response to a mapi login challenge """
         challenges = challenge.split(':')
         salt, identity, protocol, hashes, endian = challenges[:5]
-        password = self.password
 
         if protocol == '9':
-            algo = challenges[5]
-            try:
-                h = hashlib.new(algo)
-                h.update(password.encode())
-                password = h.hexdigest()
-            except ValueError as e:
-                raise NotSupportedError(e.message)
+            password = self._hash_password(challenges[5])
         else:
             raise NotSupportedError("We only speak protocol v9")
 
@@ -268,6 +266,19 @@ class Connection(object):
         return ":".join(["BIG", self.username, pwhash, self.language,
                          self.database]) + ":"
 
+    def _hash_password(self, algo):
+        """ hash the password with the algorithm the server asks for. Only
+        the salt changes between logins, so the result is cached """
+        key = (algo, self.password)
+        if key not in self._password_hashes:
+            try:
+                h = hashlib.new(algo)
+            except ValueError as e:
+                raise NotSupportedError(str(e))
+            h.update(self.password.encode())
+            self._password_hashes[key] = h.hexdigest()
+        return self._password_hashes[key]
+
     def _getblock(self):
         """ read one mapi encoded block """
         if (self.language == 'control' and not self.hostname):
@@ -317,9 +328,12 @@ class Connection(object):
         return result.getvalue()
 
     def _putblock(self, block):
-        """ wrap the line in mapi format and put it into the socket """
+        """ wrap the line in mapi format and put it into the socket. block
+        can be a str or already encoded bytes """
+        if isinstance(block, str):
+            block = block.encode()
         if (self.language == 'control' and not self.hostname):
-            return self.socket.send(block.encode())  # control doesn't do block
+            return self.socket.send(block)  # control doesn't do block
                                             # splitting when using a socket
         else:
             self._putblock_inet(block)
@@ -328,7 +342,7 @@ class Connection(object):
         pos = 0
         last = 0
         while not last:
-            data = block[pos:pos + MAX_PACKAGE_LENGTH].encode()
+            data = block[pos:pos + MAX_PACKAGE_LENGTH]
             length = len(data)
             if length < MAX_PACKAGE_LENGTH:
                 last = 1
@@ -341,8 +355,12 @@ class Connection(object):
                 while parent and not select([], [self.socket.fileno()], [], 0)[1]:
                     parent.switch(POLL_WRITE)
 
-            self.socket.send(flag)
-            self.socket.send(data)
+            # send header and data in one go, using the same buffer each time
+            buf = self._sendbuf
+            del buf[:]
+            buf += flag
+            buf += data
+            self.socket.sendall(buf)
             pos += length
 
     def __del__(self):
@@ -16,8 +16,11 @@
 # All Rights Reserved.
 
 import os
+import socket
 import unittest
 import logging
+from datetime import datetime
+from unittest import mock
 
 try:
     import monetdb
@@ -29,8 +32,11 @@ except ImportError:
     sys.path.append(parent)
     import monetdb
 
-from monetdb.control import Control
-from monetdb.exceptions import OperationalError
+from monetdb.control import (Control, parse_statusline, parse_statuslines,
+                             parse_statuslines_columnar)
+from monetdb import control
+from monetdb.exceptions import OperationalError, InterfaceError
+from monetdb import mapi
 
 #logging.basicConfig(level=logging.DEBUG)
 
@@ -101,6 +107,21 @@ class TestControl(unittest.TestCase):
         do_without_fail(lambda: self.control.destroy(status1))
         do_without_fail(lambda: self.control.destroy(status2))
 
+    def testStatusMany(self):
+        statuses = self.control.status_many([database_name, "nonexisting"])
+        self.assertEqual([status["name"] for status in statuses],
+                         [database_name])
+
+    def testStatusTable(self):
+        table = self.control.status_table()
+        self.assertTrue(database_name in table.name)
+
+    def testStatusInvalidated(self):
+        do_without_fail(lambda: self.control.release(database_name))
+        self.control.status(database_name)
+        self.control.lock(database_name)
+        self.assertTrue(self.control.status(database_name)["locked"])
+
     def testStart(self):
         do_without_fail(lambda: self.control.stop(database_name))
         self.assertTrue(self.control.start(database_name))
@@ -146,5 +167,195 @@ class TestControl(unittest.TestCase):
     def testNeighbours(self):
         neighbours = self.control.neighbours()
 
+
+class TestParseStatusline(unittest.TestCase):
+    v1 = "=sabdb:1:demo,/var/demo,0,1,sql'mal,0,3,2,1,10,20,5,-1,1400000000,0,0.5,0.25"
+    v2 = "=sabdb:2:demo,/var/demo,1,3,sql,3,2,1,10,20,5,1400000100,1400000000,-1,1,0.5,0.25"
+
+    def testVersion1(self):
+        info = parse_statusline(self.v1)
+        self.assertEqual(info["name"], "demo")
+        self.assertEqual(info["path"], "/var/demo")
+        self.assertFalse(info["locked"])
+        self.assertEqual(info["scenarios"], ["sql", "mal"])
+        self.assertEqual(info["start_counter"], 3)
+        self.assertEqual(info["min_uptime"], 5)
+        self.assertIsNone(info["last_crash"])
+        self.assertFalse("last_stop" in info)
+        self.assertEqual(info["crash_avg30"], 0.25)
+
+    def testVersion2(self):
+        info = parse_statusline(self.v2)
+        self.assertTrue(info["locked"])
+        self.assertEqual(info["state"], 3)
+        self.assertEqual(info["last_crash"], datetime.fromtimestamp(1400000100))
+        self.assertEqual(info["last_start"], datetime.fromtimestamp(1400000000))
+        self.assertIsNone(info["last_stop"])
+        self.assertTrue(info["crash_avg1"])
+
+    def testStatuslines(self):
+        infos = parse_statuslines(self.v1 + "\n" + self.v2)
+        self.assertEqual(infos, [parse_statusline(self.v1),
+                                 parse_statusline(self.v2)])
+        self.assertEqual(len(parse_statuslines(self.v1 + "\n")), 1)
+        self.assertEqual(parse_statuslines(""), [])
+
+    def testColumnar(self):
+        table = parse_statuslines_columnar(self.v1 + "\n" + self.v2)
+        self.assertEqual(len(table), 2)
+        for i, line in enumerate((self.v1, self.v2)):
+            info = parse_statusline(line)
+            for field in table.__slots__:
+                self.assertEqual(getattr(table, field)[i], info.get(field))
+        self.assertEqual(len(parse_statuslines_columnar("")), 0)
+
+    def testBytes(self):
+        self.assertEqual(parse_statusline(self.v2.encode()),
+                         parse_statusline(self.v2))
+        self.assertEqual(parse_statuslines(self.v2.encode()),
+                         [parse_statusline(self.v2)])
+
+    def testWrongResult(self):
+        self.assertRaises(OperationalError, parse_statusline, "garbage")
+
+    def testFieldLayout(self):
+        # the parsers unpack the fields in the order _FIELDS lists them
+        for line in (self.v1, self.v2):
+            prot_version = line.split(":")[1]
+            fields = [f for f in control._FIELDS[prot_version] if f]
+            self.assertEqual(list(parse_statusline(line)), fields)
+
+    def testShortLine(self):
+        short = self.v2.rsplit(",", 3)[0]
+        self.assertRaises(OperationalError, parse_statusline, short)
+        self.assertRaises(OperationalError, parse_statuslines_columnar, short)
+
+    def testUnsupportedProtocol(self):
+        self.assertRaises(InterfaceError, parse_statusline,
+                          self.v2.replace("sabdb:2", "sabdb:3"))
+
+
+class FakeConnection(object):
+    """ stands in for mapi.Connection, cmd() pops its result from replies,
+    raising it if it is an exception """
+    def __init__(self):
+        self.state = mapi.STATE_INIT
+        self.hostname = ""
+        self.connectionclosed = False
+        self.socket = None
+        self.peer = None
+        self.connects = 0
+        self.sent = []
+        self.replies = []
+
+    def connect(self, hostname=None, **kwargs):
+        self.connects += 1
+        self.hostname = hostname
+        self.socket, self.peer = socket.socketpair()
+        self.connectionclosed = False
+        self.state = mapi.STATE_READY
+
+    def disconnect(self):
+        self.state = mapi.STATE_INIT
+        if self.socket:
+            self.socket.close()
+            self.peer.close()
+
+    def cmd(self, operation):
+        self.sent.append(operation)
+        reply = self.replies.pop(0) if self.replies else ""
+        if isinstance(reply, BaseException):
+            if str(reply) == "Server closed connection":
+                self.connectionclosed = True  # like mapi._getbytes()
+            raise reply
+        return reply
+
+
+class TestControlConnection(unittest.TestCase):
+    def setUp(self):
+        patcher = mock.patch.object(mapi, "Connection", FakeConnection)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.control = Control("localhost", MAPIPORT, TSTPASSPHRASE)
+        self.addCleanup(self.control.close)
+        self.connection = self.control.server
+
+    def testConnectionReused(self):
+        self.control.start(database_name)
+        self.control.stop(database_name)
+        self.assertEqual(self.connection.connects, 1)
+
+    def testServerErrorKeepsConnection(self):
+        self.connection.replies = [OperationalError("no such database")]
+        self.assertRaises(OperationalError, self.control.stop, database_name)
+        self.assertEqual(self.connection.state, mapi.STATE_READY)
+
+    def testInterruptedCommandDisconnects(self):
+        self.connection.replies = [KeyboardInterrupt()]
+        self.assertRaises(KeyboardInterrupt, self.control.stop, database_name)
+        self.assertEqual(self.connection.state, mapi.STATE_INIT)
+        self.control.stop(database_name)
+        self.assertEqual(self.connection.connects, 2)
+
+    def testClosedIdleConnectionReconnects(self):
+        self.connection.peer.close()  # server closes the idle connection
+        self.control.stop(database_name)
+        self.assertEqual(self.connection.connects, 2)
+        self.assertEqual(self.connection.sent, [b"controltest_other stop\n"])
+
+    def testReadOnlyCommandRetried(self):
+        self.connection.replies = [ConnectionResetError(), "=readonly=yes"]
+        self.assertEqual(self.control.get(database_name), {"readonly": "yes"})
+        self.assertEqual(self.connection.connects, 2)
+        self.assertEqual(len(self.connection.sent), 2)
+
+    def testUpdateNotRetried(self):
+        self.connection.replies = [ConnectionResetError()]
+        self.assertRaises(ConnectionResetError, self.control.destroy,
+                          database_name)
+        self.assertEqual(len(self.connection.sent), 1)
+        self.assertEqual(self.connection.state, mapi.STATE_INIT)
+
+    def testServerCloseOfUpdateNotRetried(self):
+        self.connection.replies = [OperationalError("Server closed connection")]
+        self.assertRaises(OperationalError, self.control.kill, database_name)
+        self.assertEqual(len(self.connection.sent), 1)
+        self.assertEqual(self.connection.state, mapi.STATE_INIT)
+
+    def testPool(self):
+        control = Control("localhost", MAPIPORT, TSTPASSPHRASE, pool_size=2)
+        self.assertEqual(len(control._connections), 2)
+        control.start(database_name)
+        control.start(database_name)
+        self.assertEqual(sum(len(c.sent) for c in control._connections), 2)
+        control.close()
+
+    def testStatusResultsAreDicts(self):
+        self.connection.replies = [TestParseStatusline.v2]
+        first = self.control.status("demo")
+        self.assertTrue(isinstance(first, dict))
+        first["scenarios"].append("mal")
+        self.assertEqual(self.control.status()[0]["scenarios"], ["sql"])
+        self.assertEqual(len(self.connection.sent), 1)
+
+    def testStatusEmptyNameIsAll(self):
+        self.connection.replies = [TestParseStatusline.v2,
+                                   TestParseStatusline.v2]
+        self.assertEqual(len(self.control.status("")), 1)
+        self.control.invalidate_status()
+        self.assertEqual(len(self.control.status(False)), 1)
+        self.assertEqual(self.connection.sent, [b"#all status\n"] * 2)
+
+    def testStatusGlobSingleRequest(self):
+        self.connection.replies = [TestParseStatusline.v2]
+        self.assertEqual(self.control.status("de*")["name"], "demo")
+        self.assertEqual(self.connection.sent, [b"de* status\n"])
+
+    def testUnixSocketClosedAfterCommand(self):
+        control = Control(None, MAPIPORT, TSTPASSPHRASE)
+        control.stop(database_name)
+        self.assertEqual(control.server.state, mapi.STATE_INIT)
+
+
 if __name__ == '__main__':
     unittest.main()